@@ -0,0 +1,135 @@
+import glob
+import os
+import random
+import sys
+
+import cv2
+import numpy as np
+import onnxruntime as ort
+import torch
+import torch.serialization
+import torchvision.models.mobilenetv2 as mobilenetv2
+from onnxruntime.quantization import (
+    CalibrationDataReader,
+    QuantFormat,
+    QuantType,
+    quantize_static,
+)
+from onnxruntime.quantization.shape_inference import quant_pre_process
+
+IMG_SIZE = 224
+CALIB_IMAGES = 200
+CHECK_IMAGES = 200
+# server.py reports int(prob * 100), so 0.02 is two points of "Lung health"
+MAX_PROB_DIFF = 0.02
+
+paths = sorted(glob.glob("dataset/*/*"))
+if len(paths) < 2:
+    sys.exit("❌ dataset/ is missing or empty: static quantization needs "
+             "dataset/<class>/<image> files to calibrate and check against")
+random.Random(0).shuffle(paths)
+
+# Disjoint slices: calibrate on one, check accuracy on images it never saw
+n_calib = min(CALIB_IMAGES, len(paths) // 2)
+calib_paths = paths[:n_calib]
+check_paths = paths[n_calib:n_calib + CHECK_IMAGES]
+
+
+# Preprocessed exactly like server.py
+def preprocess(path):
+    img = cv2.imread(path)
+    if img is None:
+        return None
+
+    small = cv2.resize(img, (IMG_SIZE, IMG_SIZE), interpolation=cv2.INTER_AREA)
+    return cv2.dnn.blobFromImage(small, scalefactor=1 / 255.0, swapRB=True, crop=False)
+
+
+def softmax(x):
+    e = np.exp(x - x.max(axis=1, keepdims=True))
+    return e / e.sum(axis=1, keepdims=True)
+
+
+# Load the trained model (no retraining needed)
+torch.serialization.add_safe_globals([mobilenetv2.MobileNetV2])
+
+model = torch.load(
+    "lung_model.pth",
+    map_location=torch.device("cpu"),
+    weights_only=False
+)
+model.eval()
+
+# Export FP32 ONNX with a dynamic batch axis (server batches requests)
+torch.onnx.export(
+    model,
+    torch.zeros(1, 3, IMG_SIZE, IMG_SIZE),
+    "lung_model.onnx",
+    input_names=["input"],
+    output_names=["output"],
+    dynamic_axes={"input": {0: "batch"}, "output": {0: "batch"}},
+)
+
+quant_pre_process("lung_model.onnx", "lung_model.prep.onnx")
+
+
+class LungCalibration(CalibrationDataReader):
+    def __init__(self, paths):
+        self.paths = iter(paths)
+
+    def get_next(self):
+        for path in self.paths:
+            blob = preprocess(path)
+            if blob is not None:
+                return {"input": blob}
+
+        return None
+
+
+# Static INT8 in QDQ format: the layout ORT's CPU provider has int8 conv kernels for.
+# Written to a candidate path; server.py picks up lung_model.int8.onnx only once it passes the check.
+CANDIDATE = "lung_model.int8.candidate.onnx"
+
+quantize_static(
+    "lung_model.prep.onnx",
+    CANDIDATE,
+    LungCalibration(calib_paths),
+    quant_format=QuantFormat.QDQ,
+    activation_type=QuantType.QInt8,
+    weight_type=QuantType.QInt8,
+    per_channel=True,
+)
+
+# Compare the "normal" probability server.py shows against the FP32 .pth model
+sess = ort.InferenceSession(CANDIDATE, providers=["CPUExecutionProvider"])
+diffs = []
+
+with torch.no_grad():
+    for path in check_paths:
+        blob = preprocess(path)
+        if blob is None:
+            continue
+
+        fp32 = torch.softmax(model(torch.from_numpy(blob)), dim=1).numpy()
+        int8 = softmax(sess.run(None, {"input": blob})[0])
+        diffs.append(abs(float(fp32[0][1]) - float(int8[0][1])))
+
+if not diffs:
+    os.remove(CANDIDATE)
+    sys.exit("❌ No readable held-out images in dataset/ to check the INT8 model against")
+
+worst = max(diffs)
+print(f"INT8 vs FP32 on {len(diffs)} held-out images: "
+      f"max diff {worst:.4f}, mean diff {np.mean(diffs):.4f}")
+
+if worst > MAX_PROB_DIFF:
+    os.remove(CANDIDATE)
+    # an older INT8 export no longer matches this lung_model.pth either
+    if os.path.exists("lung_model.int8.onnx"):
+        os.remove("lung_model.int8.onnx")
+    sys.exit(f"❌ INT8 model drifts {worst:.4f} from FP32 (limit {MAX_PROB_DIFF}); "
+             "lung_model.int8.onnx not written, server.py stays on lung_model.pth")
+
+os.replace(CANDIDATE, "lung_model.int8.onnx")
+
+print("🔥 ONNX Model Saved")
@@ -0,0 +1,16 @@
+import os
+
+# gunicorn server:app
+#
+# gthread rather than gevent: inference, heatmaps and DB writes run on real
+# threads (OpenCV / onnxruntime / torch release the GIL), which gevent's
+# monkey-patching would turn into greenlets blocking one hub.
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", 8))
+timeout = 120
+
+# no preload_app: each worker starts its own batcher / writer threads and
+# SQLite connections after fork
+preload_app = False
@@ -1,193 +1,623 @@
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, Response, request, jsonify, send_file, send_from_directory, stream_with_context
+from flask.json.provider import JSONProvider
 import cv2
+import numpy as np
+import io
 import os
+import re
+import mimetypes
+import tempfile
+import functools
+import hashlib
+import atexit
 import sqlite3
-import traceback
 import requests
+from requests.adapters import HTTPAdapter
+import orjson
+import queue
+import bisect
+import threading
+import time
+import uuid
 
-from datetime import datetime
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
 
-from reportlab.lib.pagesizes import A4
-from reportlab.pdfgen import canvas
+from werkzeug.exceptions import RequestEntityTooLarge, ServiceUnavailable
+from werkzeug.utils import secure_filename
 
-# ✅ NEW IMPORTS (AI MODEL)
-import torch
-import torchvision.transforms as transforms
-from PIL import Image
+try:
+    from numba import njit
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
 
 
 # ================= APP =================
+class OrjsonProvider(JSONProvider):
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
+app.config["MAX_CONTENT_LENGTH"] = int(os.getenv("MAX_UPLOAD_MB", 32)) * 1024 * 1024
 
 
 # ================= CONFIG =================
 DB = "database.db"
 UPLOAD = "uploads"
 HEAT = "heatmaps"
+REPORTS = "reports"
+HEAT_SIZE = int(os.getenv("HEAT_SIZE", 512))
+HEAT_FORMAT = os.getenv("HEAT_FORMAT", "jpg").strip().lower().lstrip(".")
+HEAT_FORMAT = {"jpeg": "jpg"}.get(HEAT_FORMAT, HEAT_FORMAT)
+IMG_SIZE = 224
 
 OPENROUTER_KEY = os.getenv("OPENROUTER_KEY")
 
+# /chat replies expire so answers track changes behind openrouter/auto
+CHAT_CACHE_TTL = int(os.getenv("CHAT_CACHE_TTL", 7 * 24 * 3600))
+CHAT_CACHE_MAX = int(os.getenv("CHAT_CACHE_MAX", 5000))
+
+# let the front server copy heatmap bytes with sendfile(2):
+#   Apache/lighttpd: USE_X_SENDFILE=1
+#   nginx: HEAT_ACCEL=/internal_heatmaps/ plus
+#     location /internal_heatmaps/ { internal; alias /app/heatmaps/; sendfile on; }
+app.config["USE_X_SENDFILE"] = os.getenv("USE_X_SENDFILE") == "1"
+HEAT_ACCEL = os.getenv("HEAT_ACCEL")
+
 os.makedirs(UPLOAD, exist_ok=True)
 os.makedirs(HEAT, exist_ok=True)
+os.makedirs(REPORTS, exist_ok=True)
+
+
+# ================= HTTP =================
+# pooled keep-alive connections to OpenRouter, reused across /chat calls
+HTTP = requests.Session()
+HTTP.mount("https://", HTTPAdapter(pool_connections=10, pool_maxsize=20))
+
+
+# ================= WORKERS =================
+# heatmap rendering and upload writes run here, off the request thread;
+# OpenCV and the model runtime release the GIL so these overlap inference
+EXEC = ThreadPoolExecutor(max_workers=os.cpu_count())
+
+cv2.setNumThreads(min(4, os.cpu_count() or 1))
 
 
 # ================= AI MODEL LOAD =================
-try:
-    import torchvision.models.mobilenetv2 as mobilenetv2
-    import torch.serialization
+# written by export_onnx.py from lung_model.pth
+ONNX_MODEL = "lung_model.int8.onnx"
 
-    torch.serialization.add_safe_globals([mobilenetv2.MobileNetV2])
 
-    model = torch.load(
-        "lung_model.pth",
-        map_location=torch.device("cpu"),
-        weights_only=False
-    )
+# loaded on the first /predict, so workers fork before torch/onnxruntime init
+@functools.lru_cache(maxsize=1)
+def load_model():
+    try:
+        if os.path.exists(ONNX_MODEL):
+            import onnxruntime as ort
 
-    model.eval()
-    print("✅ Model loaded successfully")
+            session = ort.InferenceSession(
+                ONNX_MODEL,
+                providers=["CPUExecutionProvider"]
+            )
+            input_name = session.get_inputs()[0].name
+            print("✅ ONNX model loaded successfully")
 
-except Exception as e:
-    print("❌ Model load failed:", e)
-    model = None
+            def run(batch):
+                return session.run(None, {input_name: batch})[0]
 
+            return run
 
-transform = transforms.Compose([
-    transforms.Resize((224,224)),
-    transforms.ToTensor(),
-])
+    except Exception as e:
+        print("❌ ONNX model load failed:", e)
+
+    try:
+        import torch
+        import torchvision.models.mobilenetv2 as mobilenetv2
+        import torch.serialization
+
+        torch.serialization.add_safe_globals([mobilenetv2.MobileNetV2])
+
+        model = torch.load(
+            "lung_model.pth",
+            map_location=torch.device("cpu"),
+            weights_only=False
+        )
+
+        model.eval()
+        print("✅ Model loaded successfully")
+
+        # trace + freeze once so requests skip eager-mode Python dispatch
+        try:
+            example = torch.zeros(1, 3, IMG_SIZE, IMG_SIZE)
+
+            with torch.no_grad():
+                model = torch.jit.optimize_for_inference(torch.jit.trace(model, example))
+                model(example)
+
+        except Exception as e:
+            print("❌ TorchScript trace failed, using eager model:", e)
+
+        def run(batch):
+            with torch.inference_mode():
+                return model(torch.from_numpy(batch)).numpy()
+
+        return run
+
+    except Exception as e:
+        print("❌ Model load failed:", e)
+        return None
+
+
+def softmax(x):
+    e = np.exp(x - x.max(axis=1, keepdims=True))
+    return e / e.sum(axis=1, keepdims=True)
+
+
+# ================= INFERENCE BATCHER =================
+# concurrent /predict calls are coalesced into one forward pass
+BATCH_MAX = 16
+BATCH_WAIT = 0.02
+
+infer_q = queue.Queue()
+
+
+def batch_worker():
+    while True:
+        items = [infer_q.get()]
+        deadline = time.monotonic() + BATCH_WAIT
+
+        while len(items) < BATCH_MAX:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                break
+            try:
+                items.append(infer_q.get(timeout=left))
+            except queue.Empty:
+                break
+
+        try:
+            run = load_model()
+
+            if run is None:
+                for _, fut in items:
+                    fut.set_result(None)
+                continue
+
+            probs = softmax(run(np.concatenate([x for x, _ in items])))
+
+            for i, (_, fut) in enumerate(items):
+                fut.set_result(float(probs[i][1]))
+
+        except Exception as e:
+            for _, fut in items:
+                fut.set_exception(e)
+
+
+threading.Thread(target=batch_worker, daemon=True).start()
 
 
 # ================= DATABASE =================
+# one shared autocommit connection; WAL lets readers run while a write lands
+DB_CONN = sqlite3.connect(DB, check_same_thread=False, isolation_level=None)
+DB_CONN.execute("PRAGMA journal_mode=WAL")
+DB_CONN.execute("PRAGMA synchronous=NORMAL")
+DB_CONN.execute("PRAGMA temp_store=MEMORY")
+DB_CONN.execute("PRAGMA mmap_size=268435456")
+
+# serialises writers on DB_CONN; readers use READ_POOL instead
+DB_LOCK = threading.Lock()
+
+
 def init_db():
-    con = sqlite3.connect(DB)
-    cur = con.cursor()
-
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS patients(
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        name TEXT,
-        date TEXT,
-        result TEXT,
-        confidence REAL,
-        image TEXT,
-        report TEXT
-    )
-    """)
+    with DB_LOCK:
+        cur = DB_CONN.cursor()
+
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS patients(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT,
+            date TEXT,
+            result TEXT,
+            confidence REAL,
+            image TEXT,
+            report TEXT
+        )
+        """)
+
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS chat_cache(
+            msg TEXT PRIMARY KEY,
+            reply TEXT,
+            created REAL
+        )
+        """)
 
-    con.commit()
-    con.close()
+        # databases from before the TTL; old rows get NULL and count as expired
+        cols = [r[1] for r in cur.execute("PRAGMA table_info(chat_cache)")]
+        if "created" not in cols:
+            cur.execute("ALTER TABLE chat_cache ADD COLUMN created REAL")
+
+        cur.execute(
+            "CREATE INDEX IF NOT EXISTS idx_chat_cache_created ON chat_cache(created)"
+        )
 
 init_db()
 
 
+READ_POOL_SIZE = 5
+READ_POOL_TIMEOUT = 10
+READ_POOL = queue.Queue()
+
+for _ in range(READ_POOL_SIZE):
+    READ_POOL.put(sqlite3.connect(
+        f"file:{DB}?mode=ro", uri=True, check_same_thread=False
+    ))
+
+
+@contextmanager
+def get_read():
+    try:
+        con = READ_POOL.get(timeout=READ_POOL_TIMEOUT)
+    except queue.Empty:
+        raise ServiceUnavailable("database busy, try again")
+
+    try:
+        yield con
+    finally:
+        READ_POOL.put(con)
+
+
 # ================= SAVE =================
-def save(name, res, conf, img, rep):
-    con = sqlite3.connect(DB)
-    cur = con.cursor()
+INSERT_PATIENT = "INSERT INTO patients VALUES(NULL,?,?,?,?,?,?)"
+
+# rows are queued and committed in batches, one WAL commit per batch
+SAVE_MAX = 32
+SAVE_WAIT = 0.05
+SAVE_RETRIES = 8
 
-    cur.execute("""
-    INSERT INTO patients VALUES(NULL,?,?,?,?,?,?)
-    """, (
+save_q = queue.Queue()
+
+
+def save(name, res, conf, img, rep):
+    save_q.put((
         name,
-        datetime.now().strftime("%d-%m-%Y %H:%M"),
+        time.strftime("%d-%m-%Y %H:%M"),
         res,
         conf,
         img,
         rep
     ))
 
-    con.commit()
-    con.close()
+
+def save_many(rows):
+    # one transaction, one WAL commit for the whole batch
+    with DB_LOCK, DB_CONN:
+        DB_CONN.execute("BEGIN")
+        DB_CONN.executemany(INSERT_PATIENT, rows)
+
+
+def is_busy(e):
+    code = getattr(e, "sqlite_errorcode", None)  # Python 3.11+
+
+    if code is not None:
+        return code & 0xff in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED)
+
+    return "locked" in str(e) or "busy" in str(e)
+
+
+def write_rows(rows):
+    delay = 0.1
+
+    # only busy/locked (another worker writing) is transient; readonly, full
+    # disk, I/O errors etc. won't clear up, so those rows are logged and dropped
+    for attempt in range(SAVE_RETRIES):
+        try:
+            save_many(rows)
+            return
+        except sqlite3.OperationalError as e:
+            if not is_busy(e) or attempt == SAVE_RETRIES - 1:
+                app.logger.exception("dropping %d patient rows: %r", len(rows), rows)
+                return
+
+            app.logger.warning(
+                "saving %d patient rows hit %s, retrying in %.1fs", len(rows), e, delay
+            )
+            time.sleep(delay)
+            delay = min(delay * 2, 5)
+
+
+def save_worker():
+    stop = False
+
+    while not stop:
+        row = save_q.get()
+        if row is None:
+            break
+
+        rows = [row]
+        deadline = time.monotonic() + SAVE_WAIT
+
+        while len(rows) < SAVE_MAX:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                break
+            try:
+                row = save_q.get(timeout=left)
+            except queue.Empty:
+                break
+            if row is None:
+                stop = True
+                break
+            rows.append(row)
+
+        try:
+            write_rows(rows)
+        except Exception:
+            app.logger.exception("dropping %d patient rows: %r", len(rows), rows)
+
+
+# daemon so it never blocks interpreter shutdown by itself; atexit hooks run
+# while daemon threads are still alive, so flush_saves drains it first
+save_thread = threading.Thread(target=save_worker, daemon=True)
+save_thread.start()
+
+
+@atexit.register
+def flush_saves():
+    save_q.put(None)
+    save_thread.join()
+
+
+# ================= CHAT CACHE =================
+def cache_key(msg):
+    return " ".join(msg.lower().split())
+
+
+def cache_get(msg):
+    with get_read() as con:
+        cur = con.execute(
+            "SELECT reply FROM chat_cache WHERE msg=? AND created >= ?",
+            (cache_key(msg), time.time() - CHAT_CACHE_TTL)
+        )
+        r = cur.fetchone()
+
+    return r[0] if r else None
+
+
+def cache_put(msg, reply):
+    now = time.time()
+
+    # misses only happen once per LLM round-trip, so pruning here is cheap
+    with DB_LOCK, DB_CONN:
+        DB_CONN.execute("BEGIN")
+        DB_CONN.execute(
+            "INSERT OR REPLACE INTO chat_cache(msg, reply, created) VALUES(?,?,?)",
+            (cache_key(msg), reply, now)
+        )
+        DB_CONN.execute(
+            "DELETE FROM chat_cache WHERE created IS NULL OR created < ?",
+            (now - CHAT_CACHE_TTL,)
+        )
+        DB_CONN.execute("""
+        DELETE FROM chat_cache WHERE msg NOT IN (
+            SELECT msg FROM chat_cache ORDER BY created DESC LIMIT ?
+        )
+        """, (CHAT_CACHE_MAX,))
+
+
+# ================= UPLOAD =================
+def write_upload(path, data):
+    try:
+        with open(path, "wb") as f:
+            f.write(data)
+    except Exception:
+        app.logger.exception("writing upload %s failed", path)
 
 
 # ================= HEATMAP =================
+# OpenCV >= 4.7: radius-independent, closer to a Gaussian than a box
+HAS_STACK_BLUR = hasattr(cv2, "stackBlur")
+
+# lossy encoders only: PNG's zlib pass is the slowest codec for a photo-like overlay
+HEAT_ENCODERS = {
+    "jpg": [
+        cv2.IMWRITE_JPEG_QUALITY, 85,
+        cv2.IMWRITE_JPEG_OPTIMIZE, 0,
+        cv2.IMWRITE_JPEG_PROGRESSIVE, 0
+    ],
+    "webp": [cv2.IMWRITE_WEBP_QUALITY, 80],
+}
+
+if HEAT_FORMAT not in HEAT_ENCODERS:
+    raise ValueError(
+        f"HEAT_FORMAT={HEAT_FORMAT!r} is not supported; "
+        f"use one of: {', '.join(HEAT_ENCODERS)}"
+    )
+
+HEAT_PARAMS = HEAT_ENCODERS[HEAT_FORMAT]
+
+# older heatmaps kept the upload's extension (heat_x.png, heat_x.JPEG, ...)
+HEAT_LEGACY_EXTS = ("jpeg", "jpe", "png", "bmp", "dib", "tif", "tiff", "jp2",
+                    "pbm", "pgm", "ppm", "pnm", "sr", "ras", "exr", "hdr", "pic")
+
+# finished heatmaps only, never .pending markers or .tmp files
+HEAT_NAME = re.compile(
+    r"[\w.\-]+\.(" + "|".join((*HEAT_ENCODERS, *HEAT_LEGACY_EXTS)) + ")",
+    re.IGNORECASE
+)
+
+JET_LUT = cv2.applyColorMap(
+    np.arange(256, dtype=np.uint8).reshape(-1, 1), cv2.COLORMAP_JET
+).reshape(256, 3)
+
+
+if HAS_NUMBA:
+    # colormap lookup + 0.6/0.4 blend in one pass, no full-size heat buffer;
+    # 154/256 and 102/256 fixed-point weights keep the loop in integer math.
+    # Serial on purpose: renders already run concurrently on EXEC threads
+    @njit(cache=True)
+    def fuse(img, blur, lut, out):
+        for y in range(img.shape[0]):
+            for x in range(img.shape[1]):
+                k = blur[y, x]
+                for c in range(3):
+                    out[y, x, c] = (154 * np.int32(img[y, x, c]) + 102 * np.int32(lut[k, c]) + 128) >> 8
+
+
+def heat_name(fname):
+    return "heat_" + os.path.splitext(fname)[0] + "." + HEAT_FORMAT
+
+
 def make_heatmap(img, fname):
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    blur = cv2.GaussianBlur(gray, (21, 21), 0)
-    heat = cv2.applyColorMap(blur, cv2.COLORMAP_JET)
-    final = cv2.addWeighted(img, 0.6, heat, 0.4, 0)
+    scale = HEAT_SIZE / max(img.shape[:2])
+    if scale < 1:
+        img = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
 
-    out = "heat_" + fname
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    if HAS_STACK_BLUR:
+        blur = cv2.stackBlur(gray, (21, 21))
+    else:
+        blur = cv2.blur(gray, (21, 21))
+
+    if HAS_NUMBA:
+        final = np.empty_like(img)
+        fuse(img, blur, JET_LUT, final)
+    else:
+        heat = cv2.LUT(cv2.cvtColor(blur, cv2.COLOR_GRAY2BGR), JET_LUT.reshape(256, 1, 3))
+        final = cv2.addWeighted(img, 0.6, heat, 0.4, 0)
+
+    out = heat_name(fname)
     path = os.path.join(HEAT, out)
 
-    cv2.imwrite(path, final)
+    ok, buf = cv2.imencode("." + HEAT_FORMAT, final, HEAT_PARAMS)
+    if not ok:
+        raise RuntimeError(f"could not encode {out}")
+
+    # encode to a temp file and rename, so readers never see a partial image
+    fd, tmp = tempfile.mkstemp(dir=HEAT, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(buf.tobytes())
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
 
     return out
 
 
+# a marker file on disk, so every gunicorn worker sees the render as pending;
+# markers older than HEAT_PENDING_TTL are treated as left over from a crash
+HEAT_PENDING_TTL = 300
+
+
+def pending_marker(heat):
+    return os.path.join(HEAT, heat + ".pending")
+
+
+def is_pending(heat):
+    try:
+        return time.time() - os.path.getmtime(pending_marker(heat)) < HEAT_PENDING_TTL
+    except FileNotFoundError:
+        return False
+
+
+def render_heatmap(img, fname):
+    try:
+        make_heatmap(img, fname)
+    except Exception:
+        app.logger.exception("heatmap render failed")
+    finally:
+        try:
+            os.remove(pending_marker(heat_name(fname)))
+        except FileNotFoundError:
+            pass
+
+
 # ================= REAL AI FUNCTION =================
-def analyze_lung_health_real(path):
-    if model is None:
-        return 50
+def analyze_lung_health_real(img):
+    small = cv2.resize(img, (IMG_SIZE, IMG_SIZE), interpolation=cv2.INTER_AREA)
 
-    img = Image.open(path).convert("RGB")
-    img = transform(img).unsqueeze(0)
+    # BGR->RGB, /255 and HWC->NCHW float32 in one OpenCV pass
+    x = cv2.dnn.blobFromImage(small, scalefactor=1 / 255.0, swapRB=True, crop=False)
 
-    with torch.no_grad():
-        output = model(img)
+    fut = Future()
+    infer_q.put((x, fut))
 
-    probs = torch.softmax(output, dim=1)
+    normal_prob = fut.result()
 
-    normal_prob = probs[0][1].item()
+    if normal_prob is None:
+        return 50
 
     return int(normal_prob * 100)
 
 
-# ================= PREDICT =================
-@app.route("/predict", methods=["POST"])
-def predict():
+# ================= SEVERITY =================
+# health > 75 -> Mild, > 50 -> Moderate, else Severe
+SEVERITY_CUTS = (50, 75)
+
+SEVERITY = (
+    (
+        "Severe",
+        "Significant lung damage detected. Immediate medical attention required.",
+        "4+ weeks",
+        "Consult Pulmonologist immediately",
+        "No smoking, strict medical care, rest",
+    ),
+    (
+        "Moderate",
+        "Moderate lung changes detected. Monitoring is recommended.",
+        "2-4 weeks",
+        "Consult doctor if symptoms persist",
+        "Avoid smoking, light exercise",
+    ),
+    (
+        "Mild",
+        "Lungs appear mostly healthy with minor or no visible damage.",
+        "1-2 weeks",
+        "Maintain healthy lifestyle",
+        "Exercise regularly, balanced diet",
+    ),
+)
 
-    try:
 
-        name = request.form.get("name", "Unknown")
+# ================= PREDICT =================
+def run_predict(name, filename, data):
+    # uuid keeps same-second uploads (and stripped/missing names) from colliding
+    fname = time.strftime("%Y%m%d%H%M%S_") + uuid.uuid4().hex + "_" + secure_filename(filename)
+    path = os.path.join(UPLOAD, fname)
 
-        if "file" not in request.files:
-            return jsonify({"error": "No file"}), 400
+    img = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
 
-        file = request.files["file"]
+    if img is None:
+        return jsonify({"error": "Invalid Image"}), 400
 
-        fname = datetime.now().strftime("%Y%m%d%H%M%S_") + file.filename
-        path = os.path.join(UPLOAD, fname)
-        file.save(path)
+    after = analyze_lung_health_real(img)
 
-        img = cv2.imread(path)
+    # only once inference succeeded, so a failed request leaves no orphan files;
+    # the heatmap still renders while the row is saved and the reply is sent
+    EXEC.submit(write_upload, path, data)
 
-        if img is None:
-            return jsonify({"error": "Invalid Image"}), 400
+    heat = heat_name(fname)
+    open(pending_marker(heat), "w").close()
+    EXEC.submit(render_heatmap, img, fname)
 
-        after = analyze_lung_health_real(path)
+    before = int(min(100, after + 10 + (after * 0.1)))
+    damage = before - after
 
-        before = int(min(100, after + 10 + (after * 0.1)))
-        damage = before - after
+    result = "Lung Analysis"
+    conf = after / 100
 
-        result = "Lung Analysis"
-        conf = after / 100
-
-        if after > 75:
-            severity = "Mild"
-            explanation = "Lungs appear mostly healthy with minor or no visible damage."
-            recovery_time = "1-2 weeks"
-        elif after > 50:
-            severity = "Moderate"
-            explanation = "Moderate lung changes detected. Monitoring is recommended."
-            recovery_time = "2-4 weeks"
-        else:
-            severity = "Severe"
-            explanation = "Significant lung damage detected. Immediate medical attention required."
-            recovery_time = "4+ weeks"
-
-        if after > 75:
-            treatment = "Maintain healthy lifestyle"
-            lifestyle = "Exercise regularly, balanced diet"
-        elif after > 50:
-            treatment = "Consult doctor if symptoms persist"
-            lifestyle = "Avoid smoking, light exercise"
-        else:
-            treatment = "Consult Pulmonologist immediately"
-            lifestyle = "No smoking, strict medical care, rest"
+    severity, explanation, recovery_time, treatment, lifestyle = \
+        SEVERITY[bisect.bisect_left(SEVERITY_CUTS, after)]
 
-        final_report = f"""
+    final_report = f"""
 Lung health is {after}%
 Estimated reduction: {damage}%
 
@@ -200,21 +630,60 @@ Advice: {treatment}
 Lifestyle: {lifestyle}
 """
 
-        heat = make_heatmap(img, fname)
+    save(name, result, conf, path, final_report)
+
+    return jsonify({
+        "prediction": result,
+        "confidence": conf,
+        "report": final_report,
+        "treatment": treatment,
+        "lifestyle": lifestyle,
+        "heatmap": heat,
+        "status": "processing"
+    })
+
+
+@app.route("/predict", methods=["POST"])
+def predict():
+
+    try:
+
+        name = request.form.get("name", "Unknown")
 
-        save(name, result, conf, path, final_report)
+        if "file" not in request.files:
+            return jsonify({"error": "No file"}), 400
+
+        file = request.files["file"]
 
-        return jsonify({
-            "prediction": result,
-            "confidence": conf,
-            "report": final_report,
-            "treatment": treatment,
-            "lifestyle": lifestyle,
-            "heatmap": heat
-        })
+        return run_predict(name, file.filename, file.stream.read())
+
+    except RequestEntityTooLarge:
+        raise
 
     except Exception as e:
-        traceback.print_exc()
+        app.logger.exception("predict failed")
+        return jsonify({"error": "Failed", "details": str(e)}), 500
+
+
+# raw image body + X-Patient / X-Filename headers, skips multipart parsing
+@app.route("/predict_stream", methods=["POST"])
+def predict_stream():
+
+    try:
+
+        name = request.headers.get("X-Patient", "Unknown")
+        data = request.get_data(cache=False)
+
+        if not data:
+            return jsonify({"error": "No file"}), 400
+
+        return run_predict(name, request.headers.get("X-Filename", "upload"), data)
+
+    except RequestEntityTooLarge:
+        raise
+
+    except Exception as e:
+        app.logger.exception("predict_stream failed")
         return jsonify({"error": "Failed", "details": str(e)}), 500
 
 
@@ -222,89 +691,209 @@ Lifestyle: {lifestyle}
 @app.route("/history")
 def history():
 
-    con = sqlite3.connect(DB)
-    cur = con.cursor()
+    limit = max(0, min(request.args.get("limit", 50, type=int), 500))
+    offset = max(0, request.args.get("offset", 0, type=int))
 
-    cur.execute("SELECT * FROM patients")
+    # fetch the (at most 500-row) page and hand the connection back before
+    # writing anything, so slow clients never hold a pooled read connection
+    with get_read() as con:
+        cur = con.cursor()
+        cur.row_factory = sqlite3.Row
 
-    rows = cur.fetchall()
+        cur.execute("""
+        SELECT id, name, date, result, confidence, image, report
+        FROM patients ORDER BY id DESC LIMIT ? OFFSET ?
+        """, (limit, offset))
 
-    con.close()
+        items = [dict(r) for r in cur]
 
-    data = []
-
-    for r in rows:
-        data.append({
-            "id": r[0],
-            "name": r[1],
-            "date": r[2],
-            "result": r[3],
-            "confidence": r[4],
-            "image": r[5],
-            "report": r[6]
-        })
-
-    return jsonify(data)
+    return Response(
+        orjson.dumps({"items": items, "next_offset": offset + len(items)}),
+        mimetype="application/json"
+    )
 
 
 # ================= HEATMAP FILE =================
 @app.route("/heatmap/<name>")
 def heat(name):
-    return send_file(os.path.join(HEAT, name))
+    if not HEAT_NAME.fullmatch(name):
+        return jsonify({"error": "Invalid name"}), 400
+
+    if is_pending(name):
+        return jsonify({"status": "processing"}), 202
+
+    # names carry a per-upload uuid, so a written heatmap never changes
+    if HEAT_ACCEL:
+        if not os.path.isfile(os.path.join(HEAT, name)):
+            return jsonify({"error": "Not found"}), 404
+
+        resp = Response(mimetype=mimetypes.guess_type(name)[0])
+        resp.headers["X-Accel-Redirect"] = HEAT_ACCEL + name
+    else:
+        resp = send_from_directory(
+            HEAT,
+            name,
+            conditional=True,
+            max_age=31536000
+        )
+    resp.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+
+    return resp
 
 
 # ================= PDF =================
+def build_pdf(r):
+    from reportlab.lib.pagesizes import A4
+    from reportlab.pdfgen import canvas
+
+    buf = io.BytesIO()
+    c = canvas.Canvas(buf, pagesize=A4)
+
+    w, h = A4
+
+    c.setFont("Helvetica-Bold", 20)
+    c.drawString(150, h-50, "AI Lung Health Report")
+
+    t = c.beginText(50, h-120)
+    t.setFont("Helvetica", 12, leading=25)
+
+    t.textLines([
+        f"Name: {r[1]}",
+        f"Date: {r[2]}",
+        f"Result: {r[3]}",
+        f"Confidence: {r[4]*100:.2f}%",
+    ])
+
+    t.moveCursor(0, 15)
+    t.setLeading(20)
+
+    t.textLines([line.strip() for line in r[6].split("\n") if line.strip()])
+
+    c.drawText(t)
+
+    c.save()
+
+    return buf.getvalue()
+
+
 @app.route("/generate_pdf/<int:pid>")
 def generate_pdf(pid):
 
-    con = sqlite3.connect(DB)
-    cur = con.cursor()
-
-    cur.execute("SELECT * FROM patients WHERE id=?", (pid,))
-    r = cur.fetchone()
-    con.close()
+    with get_read() as con:
+        cur = con.execute("SELECT * FROM patients WHERE id=?", (pid,))
+        r = cur.fetchone()
 
     if r is None:
         return jsonify({"error": "No record found"})
 
-    file = f"report_{pid}.pdf"
-    c = canvas.Canvas(file, pagesize=A4)
+    # keyed on row content, not just pid: ids restart at 1 if database.db is
+    # recreated while reports/ survives
+    digest = hashlib.sha256(orjson.dumps(list(r))).hexdigest()[:16]
+    file = os.path.join(REPORTS, f"report_{pid}_{digest}.pdf")
+
+    if not os.path.exists(file):
+        pdf = build_pdf(r)
+
+        # unique across gunicorn workers, not just threads
+        fd, tmp = tempfile.mkstemp(dir=REPORTS, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(pdf)
+            os.replace(tmp, file)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    return send_file(
+        file,
+        mimetype="application/pdf",
+        as_attachment=True,
+        download_name=f"report_{pid}.pdf",
+        conditional=True
+    )
 
-    w, h = A4
 
-    c.setFont("Helvetica-Bold", 20)
-    c.drawString(150, h-50, "AI Lung Health Report")
+# ================= CHAT (🔥 FINAL FIXED) =================
+def sse_relay(r, msg):
+    parts = []
+    done = False
+    failed = False
 
-    c.setFont("Helvetica", 12)
-    y = h-120
+    try:
+        for line in r.iter_lines():
+            if not line.startswith(b"data: "):
+                continue
 
-    c.drawString(50, y, f"Name: {r[1]}"); y -= 25
-    c.drawString(50, y, f"Date: {r[2]}"); y -= 25
-    c.drawString(50, y, f"Result: {r[3]}"); y -= 25
-    c.drawString(50, y, f"Confidence: {r[4]*100:.2f}%"); y -= 40
+            yield line + b"\n\n"
 
-    for line in r[6].split("\n"):
-        if line.strip():
-            c.drawString(50, y, line.strip())
-            y -= 20
+            payload = line[6:]
 
-    c.save()
+            if payload == b"[DONE]":
+                done = True
+                break
 
-    return send_file(file, as_attachment=True)
+            try:
+                chunk = orjson.loads(payload)
+            except ValueError:
+                continue
+
+            if not isinstance(chunk, dict):
+                continue
+
+            # in-stream errors: the reply is cut off, never cache it
+            choice = (chunk.get("choices") or [{}])[0]
+            if "error" in chunk or choice.get("finish_reason") == "error":
+                failed = True
+                continue
+
+            content = (choice.get("delta") or {}).get("content")
+            if content:
+                parts.append(content)
+
+    # chat()'s try has already returned by now, so report upstream drops here
+    except Exception:
+        failed = True
+        app.logger.exception("OpenRouter stream failed")
+        yield b"data: " + orjson.dumps(
+            {"error": {"message": "AI service stream was interrupted"}}
+        ) + b"\n\n"
+
+    finally:
+        r.close()
+
+    reply = "".join(parts)
+
+    if done and not failed and reply.strip():
+        cache_put(msg, reply)
+
+
+def sse_replay(reply):
+    yield b"data: " + orjson.dumps({"choices": [{"delta": {"content": reply}}]}) + b"\n\n"
+    yield b"data: [DONE]\n\n"
 
 
-# ================= CHAT (🔥 FINAL FIXED) =================
 @app.route("/chat", methods=["POST"])
 def chat():
     try:
         msg = request.json.get("msg", "")
 
+        # opt-in SSE; plain JSON clients are unaffected
+        stream = bool(request.json.get("stream")) or \
+            "text/event-stream" in request.headers.get("Accept", "")
+
         if msg == "":
             return jsonify({"reply": "Please ask something"})
 
         if not OPENROUTER_KEY:
             return jsonify({"reply": "OpenRouter API key is missing on the server!"})
 
+        cached = cache_get(msg)
+
+        if cached is not None:
+            if stream:
+                return Response(sse_replay(cached), mimetype="text/event-stream")
+            return jsonify({"reply": cached})
+
         headers = {
             "Authorization": f"Bearer {OPENROUTER_KEY}",
             "Content-Type": "application/json"
@@ -318,13 +907,23 @@ def chat():
             ]
         }
 
-        r = requests.post(
+        if stream:
+            data["stream"] = True
+
+        r = HTTP.post(
             "https://openrouter.ai/api/v1/chat/completions",
             headers=headers,
             json=data,
+            stream=stream,
             timeout=30
         )
 
+        if stream and r.ok:
+            return Response(
+                stream_with_context(sse_relay(r, msg)),
+                mimetype="text/event-stream"
+            )
+
         res = r.json()
 
         if "error" in res:
@@ -336,6 +935,8 @@ def chat():
 
         if reply == "No reply":
             print("Unexpected OpenRouter response:", res)
+        else:
+            cache_put(msg, reply)
 
         return jsonify({"reply": reply})
 
@@ -345,6 +946,7 @@ def chat():
 
 
 # ================= RUN =================
+# local dev only; production runs `gunicorn server:app` (see gunicorn.conf.py)
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
     app.run(host="0.0.0.0", port=port)